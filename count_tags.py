@@ -12,24 +12,39 @@ Assume tags separated by ", " which misses some tags with embedded "," like
 """
 import csv
 import sys
+from collections import Counter
+from itertools import chain
+
+
+def read_tags(filename):
+    """Yields the `can2_user_tags` value of each record"""
+    with open(filename, newline='', encoding='utf-8', buffering=1 << 20) as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader, [])
+        if 'can2_user_tags' not in header:
+            sys.exit(f"Error: '{filename}': Expected column 'can2_user_tags'")
+        tags_index = header.index('can2_user_tags')
+        for row in reader:
+            if row:
+                yield row[tags_index]
 
-tag_count = {}
-total = 0
 
 if len(sys.argv) == 1:
     print("usage: count_tags [file ...] ")
     sys.exit(-1)
 
-for filename in sys.argv[1:]:
-    with open(filename, newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            total += 1
-            for tag in row['can2_user_tags'].split(", "):
-                if tag:
-                    tag_count[tag] = tag_count.get(tag, 0) + 1
+# Many records share the same tags so count each distinct tags value across
+# all files first, then split each distinct value once
+tags_values = Counter(chain.from_iterable(read_tags(filename) for filename in sys.argv[1:]))
+total = tags_values.total()
+
+tag_count = Counter()
+for tags, records in tags_values.items():
+    for tag in tags.split(", "):
+        if tag:
+            tag_count[tag] += records
 
-tags_sorted = sorted(tag_count.items(),key=lambda x: x[1],reverse=True)
+tags_sorted = tag_count.most_common()
 
 print("count,old,new")
 for (tag, count) in tags_sorted:
@@ -22,15 +22,37 @@ Ref: https://github.com/partiallyderived/everyaction-client
 
 import argparse
 import csv
+import json
 import logging
+import mmap
 import os
 import re
 import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import cached_property
+from itertools import islice
 
 from dotenv import load_dotenv
 from everyaction import EAClient, EAHTTPException
-from everyaction.objects import Person, ActivistCodeData, Code, ActivistCode
+from everyaction.objects import Person, ActivistCodeData
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from urllib3.util.retry import Retry
+
+_NON_DIGIT = re.compile(r'\D')
+
+# Loose email shape: name@domain.tld without spaces
+_EMAIL = re.compile(r'[^@\s]+@[^@\s]+\.[^@\s]+')
+
+# Log entries of rows already synced: [999] OK ... or [999] SKIP ...
+_SYNCED_LOG_ENTRY = re.compile(rb'^\[(\d+)\] (?:OK|SKIP)\s', re.MULTILINE)
+
+# Activist Code or Tag that an ActionNetwork tag maps to
+Resolved = namedtuple('Resolved', ['id', 'name', 'is_activist'])
 
 
 class SyncActvists:
@@ -41,12 +63,24 @@ class SyncActvists:
     DEFAULT_ENV = "env/test.env"
     DEFAULT_LOGFILE = "FILENAME.LOG"
     MAXINDEX = 1000000
+    DEFAULT_THREADS = 12
+    BATCH_ROWS = 256
+    LOG_BUFFER = 1 << 16
+    EXISTING_CODES_MAX = 4096
+    TAG_MAPPING_CACHE = ".tag_mapping.cache"
+    TAG_MAPPING_CACHE_SECONDS = 24 * 60 * 60
 
     def __init__(self, env_filename):
 
         parser = self.create_arg_parser()
 
         self.args = parser.parse_args()
+        if self.args.threads < 1:
+            parser.error("--threads must be at least 1")
+
+        # --dryrun: updates become no-ops and synced rows are logged as DRYRUN
+        self.send = self._skip_send if self.args.dryrun else self._send
+        self.ok_status = "DRYRUN" if self.args.dryrun else "OK"
 
         # take environment settings from dotenv file
         load_dotenv(dotenv_path=self.args.env, verbose=True)
@@ -57,8 +91,6 @@ class SyncActvists:
             else:
                 self.args.end_row = SyncActvists.MAXINDEX
 
-        self.client = EAClient(mode=1)
-
         self.filename = self.args.inputFile or os.getenv(env_filename)
 
         self.logfile = None
@@ -66,7 +98,14 @@ class SyncActvists:
 
         self.tags_mapping_filename = "tags_mapping.csv"
 
-        self.tag_mapping = self.load_tag_mapping()
+        self.tag_mapping = self.cached_tag_mapping()
+        # can2_user_tags value -> (Resolved, ...)
+        self._tagstr_cache: dict[str, tuple[Resolved, ...]] = {}
+        # van_id -> activist code ids the person has, including codes applied
+        # this run (guarded by _existing_codes_lock as rows sync concurrently).
+        # Oldest people are dropped past EXISTING_CODES_MAX
+        self._existing_codes: dict[int, set[int]] = {}
+        self._existing_codes_lock = threading.Lock()
 
         self.address_field_mapping = {
             "can2_user_address": "addressLine1",
@@ -77,6 +116,24 @@ class SyncActvists:
             "isPreferred": True,
         }
 
+    @cached_property
+    def client(self) -> EAClient:
+        """EveryAction client, created on first use so that argument errors
+        and a tag mapping served from the cache do not build one.
+        """
+        client = EAClient(mode=1)
+        # Keep one warm connection per thread (the default pool holds 10).
+        # Rate limited (429) and gateway errors are retried with exponential
+        # backoff, waiting for Retry-After when given. Jitter spreads out the
+        # retries of threads limited at the same moment. All methods are retried
+        # as the finds, updates and activist codes sent are idempotent.
+        retry = Retry(total=5, backoff_factor=0.5, backoff_jitter=0.5,
+                      status_forcelist=(429, 502, 503, 504),
+                      allowed_methods=None, raise_on_status=False)
+        client._session.mount('https://', HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.args.threads, max_retries=retry))
+        return client
+
     def create_arg_parser(self):
         """Command line arguments and defaults
         """
@@ -107,6 +164,12 @@ class SyncActvists:
                             help="Resume importing imports (as per existing file)")
         parser.add_argument('--overwrite', action="store_true",
                             help="Overwrite existing log file")
+        parser.add_argument('--threads', '-t', type=int, default=self.DEFAULT_THREADS,
+                            metavar='N',
+                            help="Rows synced concurrently (keep within the API rate limit)")
+        parser.add_argument('--refresh-codes', action="store_true",
+                            help="Reload Activist Codes and Tags from EveryAction "
+                            "instead of using the cached tag mapping")
 
         parser.add_argument(
             'inputFile', help='Importable CSV file', default='def', nargs='?')
@@ -118,166 +181,295 @@ class SyncActvists:
 
         OK - No further action
         DRYRUN - Reports what would happen
-        """
-        if self.args.dryrun and status == "OK":
-            status = "DRYRUN"
 
-        print(f"[{rowid:0>4}] {status} {key} {message}",
-              file=self.logfile, flush=True)
+        OK and DRYRUN lines are buffered (see sync_file); others, such as
+        ERROR, are flushed immediately.
+        """
+        self.logfile.write("[%04d] %s %s %s\n" % (rowid, status, key, message))
+        if status != self.ok_status:
+            self.logfile.flush()
+
+    @staticmethod
+    def _send(api_method, *args, **kwargs):
+        """Calls an EveryAction API method that changes data"""
+        return api_method(*args, **kwargs)
+
+    @staticmethod
+    def _skip_send(api_method, *args, **kwargs):
+        """`send` for --dryrun"""
+        return None
 
     def sync_file(self):
         "Reads through file to sync user information with Every Action"
 
-        with open(self.args.logfilename, 'a', encoding='utf8') as self.logfile:
+        # Log (opened by init_logfile) is flushed after every batch of rows and
+        # when closed (including on errors) so --resume only repeats rows still
+        # buffered at a hard kill
+        with self.logfile:
             print(f"SyncTime: {datetime.now():%Y-%m-%d %H:%M:%S}",
                   file=self.logfile)
 
-            with open(self.filename, newline='', encoding='utf-8') as csvfile:
-                reader = csv.DictReader(csvfile)
-                if 'email' not in reader.fieldnames:
+            with open(self.filename, newline='', encoding='utf-8',
+                      buffering=1 << 20) as csvfile:
+                # Rows are lists indexed by column position
+                reader = csv.reader(csvfile)
+                header = next(reader, [])
+                if 'email' not in header:
                     sys.exit(
                         f"Error: '{self.filename}': Expected column 'email'")
-                #check_uuid = 'uuid' in reader.fieldnames
-                check_email_subscription_status = 'can2_subscription_status' in reader.fieldnames
-                check_phones = any((col in reader.fieldnames) for col in [
-                                   'Phone', 'Phone Number', 'can2_phone'])
-                check_tags = 'can2_user_tags' in reader.fieldnames
-
-                # Remove fields not present
-                found_fields = {}
-                for old, new in self.address_field_mapping.items():
-                    if old in reader.fieldnames:
-                        found_fields[old] = new
-                self.address_field_mapping = found_fields
-
-                rowid = 0
-                for user in reader:
-                    user_actions = []
-                    rowid += 1
-
-                    if not self.args.start_row <= rowid <= self.args.end_row:
-                        continue
-
-                    if rowid in self.skip_item:
-                        continue
+                self._col = {column: index for index, column in enumerate(header)}
+                self._col_email = self._col['email']
+                # Optional column indexes (-1 if not present)
+                self._col_status = self._col.get('can2_subscription_status', -1)
+                self._col_tags = self._col.get('can2_user_tags', -1)
+                self._col_uuid = self._col.get('uuid', -1)
+                self.check_uuid = self._col_uuid >= 0
+                self.check_email_subscription_status = self._col_status >= 0
+                # Phone column indexes (-1 if not present)
+                self._col_mobile = self._col.get('can2_phone', -1)
+                self._col_sms = self._col.get('can2_sms_status', -1)
+                self._phone_cols = [(self._col[field], field) for field in ('Phone', 'Phone Number')
+                                    if field in self._col]
+                self.check_phones = self._col_mobile >= 0 or len(self._phone_cols) > 0
+                self.check_tags = self._col_tags >= 0
+
+                # (column index, address field) for address columns present
+                self._addr_pairs: list[tuple[int, str]] = [
+                    (self._col[old], new)
+                    for old, new in self.address_field_mapping.items()
+                    if old in self._col]
+
+                # Row handlers (person, row, user_actions) for the columns present:
+                # for people already in EveryAction (unless --update) ...
+                self._existing_person_handlers = []
+                if self.check_email_subscription_status:
+                    self._existing_person_handlers.append(self.sync_email_subscription)
+                if self.check_phones:
+                    self._existing_person_handlers.append(self.sync_phones)
+                # ... and for every person found, created or updated
+                self._person_handlers = []
+                if self.check_tags:
+                    self._person_handlers.append(self.sync_row_tags)
+
+                # Only expand the parts of the person that the handlers read
+                self._expand = ",".join(
+                    part for part, needed in (("ExternalIds", self.check_uuid),
+                                              ("Emails", self.check_email_subscription_status),
+                                              ("Phones", self.check_phones))
+                    if needed)
+
+                rows = self.rows_to_sync(reader, len(header))
+
+                # Create the client before worker threads use it
+                _ = self.client
+
+                # Syncing is network bound so rows in each batch are processed
+                # concurrently; executor.map returns their log entries in row order
+                with ThreadPoolExecutor(max_workers=self.args.threads) as executor:
+                    for batch in self._iter_batches(rows, self.BATCH_ROWS):
+                        for log_entries in executor.map(self.process_row, batch):
+                            for log_entry in log_entries:
+                                self.log_actions(*log_entry)
+                        self.logfile.flush()
+
+    def process_row(self, item: tuple[int, list, str, int | None]) -> list[tuple]:
+        """Look up and sync one (rowid, row, email, first_rowid) - returns its
+        log_actions entries
+
+        Runs on worker threads so the caller writes the log in row order.
+        """
+        rowid, row, email, first_rowid = item
+        if first_rowid is not None:
+            return [(rowid, "SKIP", email, f"Duplicate (see row {first_rowid})")]
+        if not _EMAIL.fullmatch(email):
+            return [(rowid, "ERROR", email, "Invalid email")]
+        log_entries = []
+        try:
+            person, error = self.lookup_person(email)
+            if error:
+                log_entries.append((rowid, "ERROR", email, error))
+            if person and self.check_uuid:
+                if warning := self.check_action_network_id(person, row):
+                    log_entries.append((rowid, "WARNING", email, warning))
+            log_entries.append(self.sync_user(rowid, row, email, person))
+        except (EAHTTPException, RequestException) as ex:
+            # HTTP errors, or connection errors and timeouts once retries run out:
+            # log the row as failed (it is retried by --resume) on one line
+            # rather than ending the run before the batch's other rows are logged
+            log_entries.append((rowid, "ERROR", email, " ".join(str(ex).split())))
+        return log_entries
+
+    def rows_to_sync(self, reader, columns: int):
+        """Yields (rowid, row, email, first_rowid) for rows from --start to
+        --end not already synced
+
+        Short rows are padded to `columns` values. `email` is stripped, and
+        `first_rowid` is the earlier row with the same email ignoring case
+        (None for its first row) so each contact is only synced once.
+        """
+        # Blank lines are not rows (as with csv.DictReader). Rows before
+        # --start are skipped without being yielded and reading stops at --end
+        first = max(self.args.start_row, 1)
+        rows = islice(filter(None, reader), first - 1, max(self.args.end_row, first - 1))
+        # lowercased email -> first rowid with it
+        seen: dict[str, int] = {}
+        for rowid, row in enumerate(rows, first):
+            if len(row) < columns:
+                row += [''] * (columns - len(row))
+            email = row[self._col_email].strip()
+            first_rowid = seen.setdefault(email.lower(), rowid) if email else None
+            if first_rowid == rowid:
+                first_rowid = None
+
+            if rowid < len(self.skip_bitmap) and self.skip_bitmap[rowid]:
+                continue
+            yield rowid, row, email, first_rowid
+
+    @staticmethod
+    def _iter_batches(items, size: int):
+        """Yields lists of up to `size` items"""
+        items = iter(items)
+        while batch := list(islice(items, size)):
+            yield batch
+
+    def check_action_network_id(self, person: Person, row: list) -> str | None:
+        """Warning if the row's `uuid` differs from the person's ActionNetworkID
+        """
+        if not (uuid := row[self._col_uuid]):
+            return None
+        action_network_id = next(
+            (identifier for identifier in person.identifiers or ()
+             if (identifier.type or '').lower() == 'actionnetworkid'), None)
+        if action_network_id is not None and action_network_id.externalId != uuid:
+            return (f"uuid {uuid} does not match "
+                    f"ActionNetworkID {action_network_id.externalId}")
+        return None
 
-                    try:
-                        person = self.client.people.lookup(
-                            email=user['email'], expand="Addresses,ExternalIds,Emails,Phones")
-                    except AttributeError as ex:
-                        person = None
-                        self.log_actions(rowid, "ERROR", user['email'],
-                                         f"AttributeError: {ex}")
-                    if person is None:
-                        user_actions.append("create")
-                        person = self.update_or_create(user, user_actions)
-                    elif self.args.update:
-                        user_actions.append("update")
-                        person = self.update_or_create(user, user_actions)
-                    else:
-                        # Person record exists but may not have correect email subscription
-                        if person and check_email_subscription_status:
-                            self.sync_email_subscription(
-                                person, user, user_actions)
-
-                        # Person record exists but may not have email
-                        if person and check_phones:
-                            self.sync_phones(person, user, user_actions)
-
-                    if person and check_tags:
-                        self.sync_tags(person, user, user_actions)
-
-                    self.log_actions(rowid, "OK", user['email'], user_actions)
-
-    def sync_phones(self, person: Person, user: dict, user_actions: list):
+    def lookup_person(self, email: str) -> tuple[Person | None, str | None]:
+        """Look up person by email - returns (person, error message)
+        """
+        try:
+            person = self.client.people.lookup(
+                email=email, expand=self._expand)
+        except AttributeError as ex:
+            return None, f"AttributeError: {ex}"
+        return person, None
+
+    def sync_user(self, rowid: int, row: list, email: str, person: Person | None) -> tuple:
+        """Create, update or sync one CSV row with the person found (if any)
+
+        Returns the row's log_actions entry
+        """
+        user_actions = []
+        if person is None:
+            user_actions.append("create")
+            person = self.update_or_create(row, email, user_actions)
+        elif self.args.update:
+            user_actions.append("update")
+            person = self.update_or_create(row, email, user_actions)
+        else:
+            # Person record exists but may not have correct email subscription,
+            # phones etc.
+            for handler in self._existing_person_handlers:
+                handler(person, row, user_actions)
+
+        if person:
+            for handler in self._person_handlers:
+                handler(person, row, user_actions)
+
+        return rowid, self.ok_status, email, ", ".join(user_actions)
+
+    def sync_row_tags(self, person: Person, row: list, user_actions: list):
+        """Sync the row's `can2_user_tags` - see `sync_tags`
+        """
+        # Untagged rows need no tag mapping or activist code lookup
+        if user_tags := row[self._col_tags]:
+            self.sync_tags(person, self.tag_codes(user_tags), user_actions)
+
+    def sync_phones(self, person: Person, row: list, user_actions: list):
         """Sync phones for existing user
         """
         if person.phones and len(person.phones) > 0:
             return
 
-        phones = self.get_user_phones(user, user_actions)
+        phones = self.get_user_phones(row, user_actions)
         if len(phones) > 0:
-            if not self.args.dryrun:
-                try:
-                    self.client.people.update(person.van_id,
-                                              phones=phones)
-                except EAHTTPException as ex:
-                    user_actions.append(str(ex))
-                    print(
-                        f"error: {user['email']}: {phones} {ex}", file=sys.stderr)
-
-    def sync_email_subscription(self, person: Person, user: dict, user_actions: list):
+            try:
+                self.send(self.client.people.update, person.van_id,
+                          phones=phones)
+            except EAHTTPException as ex:
+                # one line, as actions are joined into a single log entry
+                user_actions.append(" ".join(str(ex).split()))
+                print(
+                    f"error: {row[self._col_email]}: {phones} {ex}", file=sys.stderr)
+
+    def sync_email_subscription(self, person: Person, row: list, user_actions: list):
         """Check email subscription status - update if needed
         """
-        preferred_contact_email = None
-        for contact_email in person.emails:
-            if contact_email.isPreferred:
-                preferred_contact_email = contact_email
-                # If subscriptionStatus is "S", "U" or "" for not subscribed
-                person_subscription_status = contact_email.subscriptionStatus or "None"
-                break
-        if user['can2_subscription_status'] == 'unsubscribed':
+        preferred_contact_email = next(
+            (contact_email for contact_email in person.emails or () if contact_email.isPreferred), None)
+        if preferred_contact_email is None:
+            return
+        # If subscriptionStatus is "S", "U" or "" for not subscribed
+        person_subscription_status = preferred_contact_email.subscriptionStatus or "None"
+        if row[self._col_status] == 'unsubscribed':
             if person_subscription_status in ('None', 'S'):
                 user_actions.append(
                     f"Unsubscribed(from '{person_subscription_status}')")
                 preferred_contact_email.isSubscribed = None
                 preferred_contact_email.subscriptionStatus = "U"
-                if not self.args.dryrun:
-                    self.client.people.update(
-                        person.van_id,
-                        emails=[preferred_contact_email])
+                self.send(self.client.people.update,
+                          person.van_id,
+                          emails=[preferred_contact_email])
         else:  # Subscribed
             if person_subscription_status == 'None':
                 user_actions.append(
                     f"Subscribed[was {person_subscription_status}]")
                 preferred_contact_email.isSubscribed = True
-                if not self.args.dryrun:
-                    self.client.people.update(
-                        person.van_id,
-                        emails=[preferred_contact_email])
+                self.send(self.client.people.update,
+                          person.van_id,
+                          emails=[preferred_contact_email])
             elif person_subscription_status == 'U':
                 user_actions.append("Can't subscribe (is 'U')")
 
-    def update_or_create(self, user: dict, user_actions: list) -> Person | None:
+    def update_or_create(self, row: list, email: str, user_actions: list) -> Person | None:
         """Create or update Every Action person based on ActionNetwork columns
 
         Attempts to find the given match candidate. If a person is found,
         it is updated with the information provided. If a person is not
         found, a new person record is created.
+
+         * `email` - the row's email, stripped
         """
 
         fields = {
             "emails": [{
-                "email": user['email'],
+                "email": email,
                 "type": "P",
                 "isPreferred": True,
-                "isSubscribed": user.get('can2_subscription_status', 'None') != 'unsubscribed',
+                "isSubscribed": self._col_status < 0 or row[self._col_status] != 'unsubscribed',
             }],
-            "firstName": user['first_name'],
-            "lastName": user['last_name']
+            "firstName": row[self._col['first_name']],
+            "lastName": row[self._col['last_name']]
         }
 
         #######################################
         # Add address if address fields found
         address = {}
-        for old, new in self.address_field_mapping.items():
-            if value := user.get(old, None):
+        for index, new in self._addr_pairs:
+            if value := row[index]:
                 address[new] = value
         if len(address) > 0:
             fields["addresses"] = [address]
 
-        phones = self.get_user_phones(user, user_actions)
+        phones = self.get_user_phones(row, user_actions)
         if len(phones) > 0:
             fields["phones"] = phones
 
-        if not self.args.dryrun:
-            person = self.client.people.find_or_create(
-                **fields)
-            return person
-
-        return None
+        # None for --dryrun
+        return self.send(self.client.people.find_or_create, **fields)
 
-    def get_user_phones(self, user: dict, user_actions: list) -> list:
+    def get_user_phones(self, row: list, user_actions: list) -> list:
         """Extract phones from import record
 
          * `can2_phone` - mobile/cell phone (newer field added by Action Network)
@@ -286,29 +478,32 @@ class SyncActvists:
          * `Phone Number` - contact phone (custom field)
         """
         #######################################
+        if not self.check_phones:
+            return []
+
         phones = []
-        phone_digits = {}
-        if user_mobile := user.get('can2_phone', ''):
+        phone_digits = set()
+        if self._col_mobile >= 0 and (user_mobile := row[self._col_mobile]):
             phone = {
                 "phoneNumber": user_mobile,
                 "phoneType": "C"
             }
-            if user.get('can2_sms_status', 'unknown') == 'subscribed':
+            if self._col_sms >= 0 and row[self._col_sms] == 'subscribed':
                 user_actions.append("mobile subscribed")
                 phone["phoneOptInStatus"] = 'I'
             else:
                 user_actions.append("mobile")
 
-            phone_digits[self.digits(user_mobile)] = True
+            phone_digits.add(self.digits(user_mobile))
             phones.append(phone)
 
         # 'Phone' - other contact phone
         # 'Phone Number' - other contact phone
-        for field in ('Phone', 'Phone Number'):
-            if user_phone := user.get(field, ''):
+        for index, field in self._phone_cols:
+            if user_phone := row[index]:
                 digits = self.digits(user_phone)
                 if digits not in phone_digits:
-                    phone_digits[digits] = True
+                    phone_digits.add(digits)
                     phone = {
                         "phoneNumber": user_phone
                     }
@@ -318,13 +513,20 @@ class SyncActvists:
         return phones
 
     def digits(self, phone):
-        """Returns digits only - used to check for duplicates"""
-        return re.sub(r'\D', '', phone.lstrip('+1'))
+        """Returns digits only - used to check for duplicates
+
+        A leading US country code is dropped so "+1 555-123-4567" and
+        "(555) 123-4567" compare equal.
+        """
+        digits = _NON_DIGIT.sub('', phone)
+        if len(digits) == 11 and digits[0] == '1':
+            return digits[1:]
+        return digits
 
-    def sync_tags(self, person: Person, user: dict, user_actions: list):
+    def sync_tags(self, person: Person, tag_codes: tuple, user_actions: list):
         """Create Activist Codes based on ActionNetwork tags
 
-         * `user['can2_user_tags']` - e.g. "SURJ_Action_Hour, SURU2021, ShowUpRiseUp 2020"
+         * `tag_codes` - `Resolved` codes from `tag_codes()`
 
         Ignores existing Every Action Activist Codes, Source Codes and Tags
 
@@ -332,48 +534,107 @@ class SyncActvists:
         https://docs.everyaction.com/reference/people-personidtype-personid-canvassresponses
         with canvassContext.omitActivistCodeContactHistory set to true
         """
-        code_by_name = {}
-        for user_tag in user['can2_user_tags'].split(", "):
-            if user_tag:
-                if user_code_data := self.tag_mapping.get(user_tag):
-                    if isinstance(user_code_data,  ActivistCode):
-                        user_code_id = user_code_data.activistCodeId
-                    elif isinstance(user_code_data,  Code):
-                        user_code_id = user_code_data.codeId
-                    else:
-                        user_code_id = None
-                        print("Internal Mapping Error:" + str(user_code_data))
-
-                    code_by_name[user_code_id] = user_code_data
-                    if self.args.verbose:
-                        print(
-                            f"Mapped tag {user_tag} to {user_code_id} ({user_code_data.name})")
+        code_by_name = {code.id: code for code in tag_codes}
 
         if len(code_by_name) > 0:
-            # existing Activist Codes
-            for code in self.client.people.activist_codes(person.van_id):
-                try:
-                    code_by_name.pop(code.activistCodeId)
-                except KeyError:
-                    pass
+            existing_codes = self.existing_activist_codes(person.van_id)
             # existing Tags - don't know what function to call
             # for code in self.client.people.codes(person.van_id):
             #    try:
             #        code_by_name.pop(code.activistCodeId)
             #    except KeyError:
             #        pass
-            for new_code_id, new_code_data in code_by_name.items():
-                if isinstance(new_code_data,  ActivistCode):
-                    user_actions.append(new_code_data.name)
-                    if not self.args.dryrun:
-                        self.client.people.apply_activist_code(
-                            new_code_id, vanId=person.van_id)
+            for new_code in code_by_name.values():
+                if new_code.is_activist:
+                    # Claim the code so another row for the same person
+                    # (synced concurrently) does not apply it again
+                    with self._existing_codes_lock:
+                        if new_code.id in existing_codes:
+                            continue
+                        existing_codes.add(new_code.id)
+                    try:
+                        self.send(self.client.people.apply_activist_code,
+                                  new_code.id, vanId=person.van_id)
+                    except Exception:
+                        with self._existing_codes_lock:
+                            existing_codes.discard(new_code.id)
+                        raise
+                    user_actions.append(new_code.name)
                 # Error in client lib
-                # elif isinstance(new_code_data,  Code):
-                #    self.client.people.add_code(van_id=person.van_id, codeId=new_code_id)
+                # else:
+                #    self.client.people.add_code(van_id=person.van_id, codeId=new_code.id)
+
+    def existing_activist_codes(self, van_id: int) -> set[int]:
+        """Ids of the Activist Codes a person has - fetched once per person
+
+        `sync_tags` adds the codes it applies to the returned set.
+        """
+        if (codes := self._existing_codes.get(van_id)) is None:
+            fetched = {code.activistCodeId
+                       for code in self.client.people.activist_codes(van_id)}
+            with self._existing_codes_lock:
+                codes = self._existing_codes.setdefault(van_id, fetched)
+                if len(self._existing_codes) > self.EXISTING_CODES_MAX:
+                    del self._existing_codes[next(iter(self._existing_codes))]
+        return codes
+
+    def tag_codes(self, user_tags: str) -> tuple[Resolved, ...]:
+        """Cached `map_tags` - the same tag string is typically shared by many
+        activists so each distinct string is split and mapped only once
+
+         * `user_tags` - e.g. "SURJ_Action_Hour, SURU2021, ShowUpRiseUp 2020"
+        """
+        if (tag_codes := self._tagstr_cache.get(user_tags)) is None:
+            tag_codes = self._tagstr_cache[user_tags] = self.map_tags(user_tags)
+        return tag_codes
+
+    def map_tags(self, user_tags: str) -> tuple[Resolved, ...]:
+        """Resolve a `can2_user_tags` value to distinct `Resolved` codes
+        """
+        code_by_name = {}
+        for user_tag in user_tags.split(", "):
+            if user_tag:
+                if user_code := self.tag_mapping.get(user_tag):
+                    code_by_name[user_code.id] = user_code
+                    if self.args.verbose:
+                        print(
+                            f"Mapped tag {user_tag} to {user_code.id} ({user_code.name})")
+        return tuple(code_by_name.values())
+
+    def cached_tag_mapping(self):
+        """`load_tag_mapping` cached on disk for TAG_MAPPING_CACHE_SECONDS
+
+        The cache is used while tags_mapping.csv and the EveryAction
+        application are unchanged. This skips listing every Activist Code
+        and Tag from EveryAction on each run.
+        """
+        cache_key = [os.path.getmtime(self.tags_mapping_filename),
+                     os.getenv('EVERYACTION_APP_NAME')]
+        if not self.args.refresh_codes:
+            try:
+                cache_age = time.time() - os.path.getmtime(self.TAG_MAPPING_CACHE)
+                if cache_age < self.TAG_MAPPING_CACHE_SECONDS:
+                    with open(self.TAG_MAPPING_CACHE, encoding='utf-8') as cache_file:
+                        cache = json.load(cache_file)
+                    if cache['key'] == cache_key:
+                        return {tag: Resolved(*code) for tag, code in cache['tags'].items()}
+            # missing, unreadable or not a cache written by this version
+            except (OSError, ValueError, KeyError, TypeError, AttributeError):
+                pass
+
+        tags_mapped = self.load_tag_mapping()
+        # The cache is only an optimization - carry on if it can't be written
+        try:
+            with open(self.TAG_MAPPING_CACHE, 'w', encoding='utf-8') as cache_file:
+                json.dump({"key": cache_key, "tags": tags_mapped}, cache_file)
+        except OSError as ex:
+            print(f"Warning: {self.TAG_MAPPING_CACHE}: {ex}", file=sys.stderr)
+        return tags_mapped
 
     def load_tag_mapping(self):
         """Look up actvist codes
+
+        Maps each tag name to a `Resolved` Activist Code or Tag
         """
         tags_mapped = {}
         code_by_name = {}
@@ -381,7 +642,7 @@ class SyncActvists:
         for code in self.client.activist_codes.list():
             if self.args.verbose:
                 print(f"load activist code: {code.name} {code}")
-            code_by_name[code.name] = code
+            code_by_name[code.name] = Resolved(code.activistCodeId, code.name, True)
 
         for code in self.client.codes.list():
             if code.codeType == 'Tag':
@@ -391,7 +652,7 @@ class SyncActvists:
                     print(
                         f"Warning: Ignoring duplicate {code.codeType} '{code.name}'", file=sys.stderr)
                 else:
-                    code_by_name[code.name] = code
+                    code_by_name[code.name] = Resolved(code.codeId, code.name, False)
 
         with open(self.tags_mapping_filename, newline='', encoding='utf-8') as csvfile:
             reader = csv.DictReader(csvfile)
@@ -423,11 +684,15 @@ class SyncActvists:
         """
         header_row = f"SyncFile: '{self.filename}'"
 
-        self.skip_item = {}
+        # skip_bitmap[rowid] is set for rows already synced
+        self.skip_bitmap = bytearray()
+        skip_item = set()
         if not self.args.logfilename or self.args.logfilename == '-':
             self.args.logfilename = "/dev/stdout"
             if self.args.resume:
                 print("Option --resume ignored for stdout", file=sys.stderr)
+            self.logfile = open(self.args.logfilename, 'a', encoding='utf8',
+                                buffering=self.LOG_BUFFER)
         else:
             if self.args.logfilename == 'og':
                 raise Exception("File: og: Do you mean --log")
@@ -440,8 +705,9 @@ class SyncActvists:
                 if self.args.resume:
                     print("Option --resume ignored. File not found",
                           file=sys.stderr)
-                with open(self.args.logfilename, 'w', encoding='utf8') as logfile:
-                    print(header_row, file=logfile)
+                self.logfile = open(self.args.logfilename, 'w', encoding='utf8',
+                                    buffering=self.LOG_BUFFER)
+                print(header_row, file=self.logfile)
             else:
                 if not self.args.resume:
                     raise Exception(
@@ -449,24 +715,31 @@ class SyncActvists:
                         ": File exists. Use --resume, --overwrite or remove file.")
 
                 print("Logile (resume):", self.args.logfilename, file=sys.stderr)
-                # Remember items to skip
-                with open(self.args.logfilename, 'r', encoding='utf8') as existing_logfile:
+                # Remember items to skip - the same handle appends this run's entries
+                self.logfile = open(self.args.logfilename, 'a+', encoding='utf8',
+                                    buffering=self.LOG_BUFFER)
+                # An empty file can't be mapped (and has no header)
+                if os.fstat(self.logfile.fileno()).st_size == 0:
+                    raise Warning(f"Logfile {self.args.logfilename} "
+                                  f"for '{self.filename}' found ''")
+                with mmap.mmap(self.logfile.fileno(), 0, access=mmap.ACCESS_READ) as log_data:
                     # SyncFile: 'downloads/export-2022-03-22-csv_report_332566_1648001887.csv'
-                    log_line = existing_logfile.readline()
-                    if log_line != header_row + "\n":
+                    log_line = log_data.readline().decode('utf8')
+                    if log_line.rstrip('\r\n') != header_row:
                         raise Warning(f"Logfile {self.args.logfilename} "
                                       f"for '{self.filename}' found '{log_line}")
-                    # [999] VERB ABC DEF -> ('[999]', 'VERB', 'ABC DEF")
-                    while True:
-                        log_line = existing_logfile.readline()
-                        if not log_line:
-                            break
-                        log_line_tokens = log_line.split(None, 2)
-                        if len(log_line_tokens) >= 2:
-                            verb = log_line_tokens[1]
-                            if verb in ('OK', 'SKIP'):
-                                itemid = int(log_line_tokens[0][1:-1])
-                                self.skip_item[itemid] = verb
+                    # [999] VERB ABC DEF
+                    skip_item.update(int(entry[1]) for entry in
+                                     _SYNCED_LOG_ENTRY.finditer(log_data, log_data.tell()))
+
+                if skip_item:
+                    # Rows after --end are never read, so ids past it (or a
+                    # corrupt entry) don't grow the bitmap
+                    size = min(max(skip_item), self.args.end_row) + 1
+                    self.skip_bitmap = bytearray(size)
+                    for itemid in skip_item:
+                        if itemid < size:
+                            self.skip_bitmap[itemid] = 1
 
 
 def main():